@@ -0,0 +1,155 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+# Settings are read from the environment when the modules below are imported,
+# so .env has to be loaded first.
+load_dotenv()
+
+from image_chat import (  # noqa: E402
+    API_CALL_FAILED,
+    FINALIZE_PROMPT_FAILED,
+    MODIFY_PROMPT_FAILED,
+    finalize_prompt,
+    generate_images,
+    modify_prompt_with_llm,
+)
+from metrics import start_metrics_server  # noqa: E402
+
+FAILED_PROMPTS = (API_CALL_FAILED, FINALIZE_PROMPT_FAILED, MODIFY_PROMPT_FAILED)
+
+
+def read_specs(path):
+    # Specs are streamed one at a time; a spec without an "id" is identified by
+    # its position so reruns of the same file line up with the checkpoint.
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for index, spec in enumerate(rows):
+            spec.setdefault("id", str(index))
+            yield spec
+
+
+def completed_ids(path):
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A partially written last line from an interrupted run.
+                continue
+            if result.get("status") == "ok":
+                done.add(result["id"])
+    return done
+
+
+def process_spec(spec, images=True):
+    started = time.monotonic()
+    prompt = spec.get("prompt", "")
+    # "conversation" is a list of {"role", "content"} turns (JSONL specs only).
+    if isinstance(spec.get("conversation"), list):
+        final_prompt = finalize_prompt(spec["conversation"])
+    elif spec.get("instruction"):
+        final_prompt = modify_prompt_with_llm(prompt, spec["instruction"])
+    else:
+        final_prompt = prompt
+    result = {"id": spec["id"], "final_prompt": final_prompt}
+    status = "failed" if not final_prompt or final_prompt in FAILED_PROMPTS else "ok"
+    if images and status == "ok":
+        image_urls = generate_images(final_prompt)
+        result["image_url"] = image_urls[0] if image_urls else None
+        result["image_urls"] = image_urls
+        if not image_urls:
+            status = "failed"
+    result["status"] = status
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return result
+
+
+def run_batch(input_path, output_path, concurrency=4, images=True, report_every=25):
+    done = completed_ids(output_path)
+    if done:
+        logging.info(f"Resuming: {len(done)} specs already completed")
+    counts = {"ok": 0, "failed": 0}
+    started = time.monotonic()
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as executor:
+        pending = set()
+        spec_ids = {}
+
+        def drain(return_when):
+            nonlocal pending
+            finished, pending = wait(pending, return_when=return_when)
+            for future in finished:
+                spec_id = spec_ids.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error(f"Spec {spec_id} failed: {e}")
+                    result = {"id": spec_id, "status": "failed", "error": str(e)}
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                counts[result["status"]] += 1
+                total = counts["ok"] + counts["failed"]
+                if total % report_every == 0:
+                    rate = total / (time.monotonic() - started)
+                    logging.info(f"{total} specs processed, {rate:.2f} items/s")
+
+        for spec in read_specs(input_path):
+            if spec["id"] in done:
+                continue
+            # Keep at most `concurrency` specs in flight so huge inputs are
+            # never loaded into memory at once.
+            if len(pending) >= concurrency:
+                drain(FIRST_COMPLETED)
+            future = executor.submit(process_spec, spec, images)
+            spec_ids[future] = spec["id"]
+            pending.add(future)
+        if pending:
+            drain(ALL_COMPLETED)
+
+    elapsed = time.monotonic() - started
+    total = counts["ok"] + counts["failed"]
+    rate = total / elapsed if elapsed else 0.0
+    logging.info(
+        f"Processed {total} specs ({counts['ok']} ok, {counts['failed']} failed) "
+        f"in {elapsed:.1f}s, {rate:.2f} items/s"
+    )
+    return {**counts, "seconds": elapsed, "items_per_second": rate}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Finalize prompts and generate images from CSV or JSONL specs."
+    )
+    parser.add_argument("input", help="CSV or JSONL file of specs")
+    parser.add_argument("output", help="JSONL results file, also used to resume")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--no-images", action="store_true", help="only produce final prompts"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    start_metrics_server()
+    summary = run_batch(
+        args.input, args.output, concurrency=args.concurrency, images=not args.no_images
+    )
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
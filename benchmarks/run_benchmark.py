@@ -0,0 +1,196 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.stub_server import IMAGE_GENERATION_PATH, StubConfig, start_stub_server
+
+SCENARIOS = ("chat", "stream", "image")
+BASE_PROMPT = (
+    "A tranquil tropical beach at sunset, with vibrant orange and pink hues painting "
+    "the sky, crystal-clear turquoise water, and a wooden pier extending into the ocean."
+)
+
+
+def configure_environment(endpoint, store_dir):
+    # Must run before image_chat is imported: every module reads its settings
+    # from the environment at import time. Quotas default high so the stub,
+    # not the client-side limiter, is what gets measured unless overridden.
+    os.environ["AZURE_ENDPOINT"] = endpoint
+    os.environ["API_KEY"] = "benchmark"
+    os.environ["API_VERSION"] = "2024-06-01"
+    os.environ["IMAGE_GENERATION_URL"] = endpoint + IMAGE_GENERATION_PATH
+    os.environ["IMAGE_STORE_DIR"] = store_dir
+    os.environ.setdefault("AZURE_RPM_LIMIT", "1000000")
+    os.environ.setdefault("AZURE_TPM_LIMIT", "1000000000")
+    os.environ.setdefault("AZURE_MAX_CONCURRENCY", "256")
+    os.environ.setdefault("HTTP_POOL_MAXSIZE", "256")
+    os.environ.setdefault("SEMANTIC_CACHE_MAX_ENTRIES", "0")
+
+
+def failure_results(image_chat):
+    # image_chat is imported only after configure_environment, so its
+    # failure constants are read from the module rather than imported here.
+    return (
+        image_chat.API_CALL_FAILED,
+        image_chat.FINALIZE_PROMPT_FAILED,
+        image_chat.MODIFY_PROMPT_FAILED,
+        image_chat.IMAGE_GENERATION_FAILED,
+    )
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def make_request(image_chat, scenario, run_id, i):
+    # Every request is unique so the response cache and single-flight layers
+    # do not hide the cost of the hot path; the semantic cache is disabled in
+    # configure_environment because these instructions are near-duplicates.
+    if scenario == "chat":
+        return image_chat.modify_prompt_with_llm(
+            BASE_PROMPT, f"make it variation {i} of run {run_id}"
+        )
+    if scenario == "stream":
+        conversation = [{"role": "user", "content": f"concept {i} of run {run_id}"}]
+        return "".join(image_chat.finalize_prompt(conversation, stream=True))
+    return image_chat.generate_image(f"{BASE_PROMPT} variation {i} of run {run_id}")
+
+
+def counter(metrics, name):
+    return sum(
+        value
+        for (counter_name, _), value in metrics.registry.counters.items()
+        if counter_name == name
+    )
+
+
+def run_level(image_chat, metrics, scenario, concurrency, requests):
+    run_id = uuid.uuid4().hex[:8]
+    latencies = []
+    errors = 0
+    retries_before = counter(metrics, "llm_retries_total")
+    throttled_before = image_chat.client.rate_limiter.stats()["throttled"]
+    failures = failure_results(image_chat)
+
+    def timed(i):
+        started = time.monotonic()
+        try:
+            result = make_request(image_chat, scenario, run_id, i)
+        except image_chat.StreamInterrupted:
+            result = None
+        return time.monotonic() - started, result in failures or not result
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, failed in executor.map(timed, range(requests)):
+            latencies.append(latency)
+            errors += failed
+    elapsed = time.monotonic() - started
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(requests / elapsed, 2),
+        "p50": round(percentile(latencies, 0.50), 4),
+        "p95": round(percentile(latencies, 0.95), 4),
+        "p99": round(percentile(latencies, 0.99), 4),
+        "retries": counter(metrics, "llm_retries_total") - retries_before,
+        "throttled": image_chat.client.rate_limiter.stats()["throttled"] - throttled_before,
+    }
+
+
+COLUMNS = (
+    "scenario",
+    "concurrency",
+    "requests",
+    "errors",
+    "throughput",
+    "p50",
+    "p95",
+    "p99",
+    "retries",
+    "throttled",
+)
+
+
+def print_row(values):
+    print(" ".join(f"{value:>11}" for value in values), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Azure client and prompt/image functions against a local stub."
+    )
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,4,16,32")
+    parser.add_argument("--requests-per-worker", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--token-delay", type=float, default=0.005)
+    parser.add_argument("--image-latency", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-ms", type=int, default=200)
+    parser.add_argument("--json", help="also write results to this JSON file")
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    server = start_stub_server(
+        StubConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            token_delay=args.token_delay,
+            image_latency=args.image_latency,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            retry_after_ms=args.retry_after_ms,
+        )
+    )
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    with tempfile.TemporaryDirectory() as store_dir:
+        configure_environment(endpoint, store_dir)
+        image_chat = importlib.import_module("image_chat")
+        metrics = importlib.import_module("metrics")
+
+        results = []
+        print_row(COLUMNS)
+        for scenario in scenarios:
+            for level in levels:
+                results.append(
+                    run_level(
+                        image_chat,
+                        metrics,
+                        scenario,
+                        level,
+                        level * args.requests_per_worker,
+                    )
+                )
+                print_row(results[-1][column] for column in COLUMNS)
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+CHAT_PATH = re.compile(r"^/openai/deployments/[^/]+/chat/completions")
+IMAGE_GENERATION_PATH = "/api/httpTriggerts"
+REPLY_WORDS = (
+    "A luminous scene with soft volumetric light, rich textures, layered depth, "
+    "a balanced composition and a gentle cinematic colour grade."
+).split()
+
+
+class StubConfig:
+    def __init__(
+        self,
+        latency=0.2,
+        jitter=0.05,
+        token_delay=0.01,
+        image_latency=1.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after_ms=200,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.image_latency = image_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+
+
+def _png_bytes():
+    buffered = BytesIO()
+    Image.new("RGB", (64, 64), (90, 140, 200)).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = StubConfig()
+    image_bytes = _png_bytes()
+
+    def _sleep(self, base):
+        time.sleep(max(0.0, random.gauss(base, self.config.jitter)))
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _inject_failure(self):
+        roll = random.random()
+        if roll < self.config.throttle_rate:
+            retry_after_ms = self.config.retry_after_ms
+            self._send_json(
+                429,
+                {"error": {"code": "429", "message": "Rate limit exceeded"}},
+                {
+                    "retry-after-ms": str(retry_after_ms),
+                    "Retry-After": str(max(1, retry_after_ms // 1000)),
+                },
+            )
+            return True
+        if roll < self.config.throttle_rate + self.config.error_rate:
+            self._send_json(500, {"error": {"code": "500", "message": "Injected error"}})
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if CHAT_PATH.match(self.path):
+            if self._inject_failure():
+                return
+            self._chat(payload)
+        elif self.path.startswith(IMAGE_GENERATION_PATH):
+            if self._inject_failure():
+                return
+            self._sleep(self.config.image_latency)
+            image_id = hashlib.sha256(payload.get("prompt", "").encode("utf-8"))
+            host = self.headers.get("Host")
+            self._send_json(
+                200, {"imageUrls": [f"http://{host}/images/{image_id.hexdigest()}.png"]}
+            )
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _chat(self, payload):
+        max_tokens = payload.get("max_tokens") or 60
+        words = [random.choice(REPLY_WORDS) for _ in range(min(max_tokens, 60))]
+        prompt_tokens = len(json.dumps(payload.get("messages", []))) // 4
+        self._sleep(self.config.latency)
+        if not payload.get("stream"):
+            self._send_json(
+                200,
+                {
+                    "choices": [{"message": {"role": "assistant", "content": " ".join(words)}}],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(words),
+                        "total_tokens": prompt_tokens + len(words),
+                    },
+                },
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, word in enumerate(words):
+            token = word if i == 0 else f" {word}"
+            chunk = {"choices": [{"delta": {"content": token}}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            time.sleep(self.config.token_delay)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if not self.path.startswith("/images/"):
+            self._send_json(404, {"error": "not found"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.image_bytes)))
+        self.end_headers()
+        self.wfile.write(self.image_bytes)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(config=None, host="127.0.0.1", port=0):
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"config": config or StubConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Local stub of the Azure OpenAI and image generation endpoints."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--image-latency", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-ms", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    config = StubConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        token_delay=args.token_delay,
+        image_latency=args.image_latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after_ms=args.retry_after_ms,
+    )
+    server = start_stub_server(config, args.host, args.port)
+    print(
+        f"Stub listening on http://{args.host}:{server.server_address[1]} "
+        f"(AZURE_ENDPOINT and IMAGE_GENERATION_URL=...{IMAGE_GENERATION_PATH})"
+    )
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
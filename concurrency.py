@@ -0,0 +1,52 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "16"))
+CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", "60"))
+
+# Shared by every session in the process, like the HTTP session in http_client.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=MAX_WORKERS, thread_name_prefix="llm"
+                )
+    return _executor
+
+
+def submit(fn, *args, **kwargs):
+    # Run in a copy of the caller's context so per-session metrics follow the call.
+    context = contextvars.copy_context()
+    return get_executor().submit(context.run, fn, *args, **kwargs)
+
+
+def gather(futures, timeout=CALL_TIMEOUT, default=None):
+    # Every future gets up to `timeout` seconds from the moment gather starts.
+    # Calls that time out are cancelled if they have not started yet; running
+    # ones are abandoned and bounded by the HTTP read timeout.
+    deadline = time.monotonic() + timeout
+    results = []
+    for future in futures:
+        remaining = max(deadline - time.monotonic(), 0)
+        try:
+            results.append(future.result(timeout=remaining))
+        except FutureTimeoutError:
+            future.cancel()
+            logging.error(f"Concurrent call timed out after {timeout} seconds")
+            results.append(default)
+        except Exception as e:
+            logging.error(f"Concurrent call failed: {e}")
+            results.append(default)
+    return results
+
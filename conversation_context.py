@@ -0,0 +1,74 @@
+import os
+from collections import deque
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+MESSAGE_TOKEN_LIMIT = int(os.getenv("CONTEXT_MESSAGE_TOKEN_LIMIT", "400"))
+
+# Rough average for English text with the GPT-4o tokenizer; close enough for
+# budgeting without pulling in a tokenizer dependency.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + "..."
+
+
+class ConversationContext:
+    # The first message (usually the initial concept or selected library prompt)
+    # is pinned; the oldest of the remaining turns are dropped once the running
+    # token count exceeds the budget.
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, message_limit=MESSAGE_TOKEN_LIMIT):
+        self.budget = budget
+        self.message_limit = message_limit
+        self.head = None
+        self.tail = deque()
+        self.total_tokens = 0
+        self.dropped = 0
+        self.synced = 0
+
+    def add(self, role, content):
+        content = truncate_to_tokens(content, self.message_limit)
+        entry = (role, content, estimate_tokens(content))
+        self.total_tokens += entry[2]
+        if self.head is None:
+            self.head = entry
+            return
+        self.tail.append(entry)
+        while self.total_tokens > self.budget and len(self.tail) > 1:
+            self.total_tokens -= self.tail.popleft()[2]
+            self.dropped += 1
+
+    def sync(self, messages):
+        # Only messages appended since the last call are tokenized, and those
+        # are still in the store's in-memory window.
+        for message in messages[self.synced :]:
+            self.add(message.role, message.content)
+        self.synced = len(messages)
+        return self
+
+    def entries(self):
+        if self.head is None:
+            return []
+        return [self.head, *self.tail]
+
+    def turns(self):
+        turns = [{"role": role, "content": content} for role, content, _ in self.entries()]
+        if self.dropped:
+            turns.insert(
+                1,
+                {
+                    "role": "system",
+                    "content": f"[{self.dropped} earlier messages omitted]",
+                },
+            )
+        return turns
+
+    def text(self):
+        return " ".join(content for _, content, _ in self.entries())
@@ -0,0 +1,146 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+
+# Turns kept in memory per session; older ones are spilled to SQLite and only
+# read back when scrolled into view.
+CONVERSATION_WINDOW = int(os.getenv("CONVERSATION_WINDOW", "40"))
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", ".session_store.sqlite3")
+# Spilled turns of sessions that have gone quiet for this long are deleted.
+SESSION_STORE_RETENTION = float(os.getenv("SESSION_STORE_RETENTION", "86400"))
+PRUNE_INTERVAL = 3600
+
+
+class Message:
+    __slots__ = ("role", "content", "recommendation")
+
+    def __init__(self, role, content, recommendation=None):
+        # Roles come from a handful of values; interning makes every message
+        # share one string object, including messages read back from disk.
+        self.role = sys.intern(role)
+        self.content = content
+        self.recommendation = recommendation
+
+
+class SpillStore:
+    def __init__(self, path=SESSION_STORE_PATH, retention=SESSION_STORE_RETENTION):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "session TEXT, position INTEGER, role TEXT, content TEXT, "
+                "recommendation TEXT, stored_at REAL, PRIMARY KEY (session, position))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_stored ON messages (stored_at)"
+            )
+        self.prune()
+
+    def write(self, session, position, message):
+        if time.time() - self._pruned_at > PRUNE_INTERVAL:
+            self.prune()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    session,
+                    position,
+                    message.role,
+                    message.content,
+                    message.recommendation,
+                    time.time(),
+                ),
+            )
+
+    def read(self, session, start, stop):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content, recommendation FROM messages "
+                "WHERE session = ? AND position >= ? AND position < ? ORDER BY position",
+                (session, start, stop),
+            ).fetchall()
+        return [Message(*row) for row in rows]
+
+    def set_recommendation(self, session, position, recommendation):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE messages SET recommendation = ? WHERE session = ? AND position = ?",
+                (recommendation, session, position),
+            )
+
+    def prune(self):
+        self._pruned_at = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM messages WHERE session IN ("
+                "SELECT session FROM messages GROUP BY session HAVING MAX(stored_at) < ?)",
+                (time.time() - self.retention,),
+            )
+
+
+_spill_store = None
+_spill_store_lock = threading.Lock()
+
+
+def get_spill_store():
+    global _spill_store
+    if _spill_store is None:
+        with _spill_store_lock:
+            if _spill_store is None:
+                _spill_store = SpillStore()
+    return _spill_store
+
+
+class ConversationStore:
+    # A list-like conversation history: positions below `spilled` live on disk,
+    # the rest in a bounded in-memory window. Supports len(), integer indexing
+    # and contiguous slices, so callers can page in just the range they show.
+    def __init__(self, window=CONVERSATION_WINDOW):
+        self.session = uuid.uuid4().hex
+        self.window = window
+        self.recent = deque()
+        self.spilled = 0
+
+    def __len__(self):
+        return self.spilled + len(self.recent)
+
+    def append(self, role, content, recommendation=None):
+        self.recent.append(Message(role, content, recommendation))
+        while len(self.recent) > self.window:
+            get_spill_store().write(self.session, self.spilled, self.recent.popleft())
+            self.spilled += 1
+        return len(self) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("ConversationStore slices must be contiguous")
+            return self.page(start, stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        return self.page(index, index + 1)[0]
+
+    def page(self, start, stop):
+        messages = []
+        if start < self.spilled:
+            messages = get_spill_store().read(
+                self.session, start, min(stop, self.spilled)
+            )
+        for position in range(max(start, self.spilled), stop):
+            messages.append(self.recent[position - self.spilled])
+        return messages
+
+    def set_recommendation(self, index, recommendation):
+        if index >= self.spilled:
+            self.recent[index - self.spilled].recommendation = recommendation
+        else:
+            get_spill_store().set_recommendation(self.session, index, recommendation)
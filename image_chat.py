@@ -0,0 +1,612 @@
+import base64
+import json
+import logging
+import os
+import re
+import time
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+from conversation_context import estimate_tokens
+from http_client import CONNECT_TIMEOUT, get_session
+from image_preprocess import (
+    VISION_MAX_DIMENSION,
+    VISION_SHORT_SIDE,
+    estimate_image_tokens,
+    prepare_for_vision,
+)
+from image_store import get_image_store
+from metrics import inc, observe, record_call, registry
+from rate_limiter import backoff_delay, get_rate_limiter
+from response_cache import get_response_cache, make_key
+from semantic_cache import get_semantic_cache
+from singleflight import Abandoned, get_flight_group
+
+azure_endpoint = os.getenv("AZURE_ENDPOINT")
+api_key = os.getenv("API_KEY")
+api_version = os.getenv("API_VERSION")
+model = "GPT-4o-mini"
+
+IMAGE_GENERATION_URL = os.getenv(
+    "IMAGE_GENERATION_URL", "https://afsimage.azurewebsites.net/api/httpTriggerts"
+)
+# Kept below IMAGE_JOB_TIMEOUT so a timed-out image job frees its worker.
+IMAGE_REQUEST_TIMEOUT = float(os.getenv("IMAGE_REQUEST_TIMEOUT", "120"))
+# Budgeted for the rate limiter when a request leaves max_tokens unset.
+DEFAULT_COMPLETION_TOKENS = 500
+
+API_CALL_FAILED = "Error in API call."
+FINALIZE_PROMPT_FAILED = "Failed to finalize prompt."
+MODIFY_PROMPT_FAILED = "Failed to modify prompt."
+IMAGE_GENERATION_FAILED = "Failed to generate image."
+IMAGE_EXPLANATION_FAILED = "Failed to get image explanation."
+
+
+class StreamInterrupted(RuntimeError):
+    # Raised from a stream that failed after some of its tokens were yielded,
+    # so the partial text is not mistaken for a complete reply.
+    pass
+# Bullets or numbering the model may add despite being asked not to.
+VARIATION_PREFIX = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+
+class AzureOpenAI:
+    def __init__(self, azure_endpoint, api_key, api_version, rate_limiter=None):
+        self.azure_endpoint = azure_endpoint
+        self.api_key = api_key
+        self.api_version = api_version
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+
+    def _request(self, model, messages, temperature, max_tokens):
+        url = f"{self.azure_endpoint}/openai/deployments/{model}/chat/completions?api-version={self.api_version}"
+        headers = {
+            "Content-Type": "application/json",
+            "api-key": self.api_key,
+        }
+        data = {"messages": messages, "temperature": temperature}
+        if max_tokens is not None:
+            data["max_tokens"] = max_tokens
+        return url, headers, data
+
+    def _with_retries(self, send, estimated_tokens, hold=False):
+        # Every attempt takes a slot from the shared rate limiter. With hold=True
+        # the caller keeps the slot after a successful send and must release it.
+        max_attempts = 5
+
+        for attempt in range(max_attempts):
+            observe("llm_queue_wait_seconds", self.rate_limiter.acquire(estimated_tokens))
+            try:
+                result = send()
+            except requests.exceptions.RequestException as e:
+                response = e.response
+                throttled = response is not None and response.status_code == 429
+                self.rate_limiter.release(throttled=throttled)
+                logging.error(f"Attempt {attempt + 1} failed: {str(e)}")
+                status = response.status_code if response is not None else "error"
+                inc("llm_failed_attempts_total", status=status)
+                if attempt < max_attempts - 1:
+                    delay = backoff_delay(attempt, response)
+                    if throttled:
+                        self.rate_limiter.pause(delay)
+                    logging.info(f"Retrying in {delay:.2f} seconds...")
+                    inc("llm_retries_total")
+                    inc("llm_backoff_seconds_total", delay)
+                    time.sleep(delay)
+                else:
+                    raise RuntimeError("Max attempts reached") from e
+            except Exception:
+                self.rate_limiter.release()
+                raise
+            else:
+                if not hold:
+                    self.rate_limiter.release()
+                return result
+
+    def chat_completion(self, model, messages, temperature, max_tokens):
+        url, headers, data = self._request(model, messages, temperature, max_tokens)
+
+        def send():
+            response = get_session().post(url, headers=headers, json=data)
+            response.raise_for_status()
+            return response.json()
+
+        return self._with_retries(send, estimate_request_tokens(messages, max_tokens))
+
+    def chat_completion_stream(self, model, messages, temperature, max_tokens):
+        url, headers, data = self._request(model, messages, temperature, max_tokens)
+        data["stream"] = True
+
+        # A failed attempt is only retried until the first token has arrived;
+        # once output has been yielded, errors propagate to the caller.
+        def send():
+            response = get_session().post(url, headers=headers, json=data, stream=True)
+            try:
+                response.raise_for_status()
+                tokens = iter_stream_tokens(response)
+                first_token = next(tokens, None)
+            except Exception:
+                response.close()
+                raise
+            return response, first_token, tokens
+
+        response, first_token, tokens = self._with_retries(
+            send, estimate_request_tokens(messages, max_tokens), hold=True
+        )
+        try:
+            if first_token is not None:
+                yield first_token
+            yield from tokens
+        finally:
+            response.close()
+            self.rate_limiter.release()
+
+
+def estimate_request_tokens(messages, max_tokens):
+    prompt_tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            prompt_tokens += estimate_tokens(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                prompt_tokens += estimate_tokens(part["text"])
+            elif part.get("type") == "image_url":
+                prompt_tokens += estimate_data_url_tokens(part["image_url"]["url"])
+    if max_tokens is None:
+        max_tokens = DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + max_tokens
+
+
+def estimate_data_url_tokens(url):
+    # Only the image header is parsed; remote URLs and unreadable data are
+    # budgeted at the largest size prepare_for_vision can produce.
+    try:
+        data = base64.b64decode(url.split(",", 1)[1])
+        size = Image.open(BytesIO(data)).size
+    except Exception:
+        size = (VISION_SHORT_SIDE, VISION_MAX_DIMENSION)
+    return estimate_image_tokens(size)
+
+
+def iter_stream_tokens(response):
+    lines = response.iter_lines()
+    for line in lines:
+        if not line:
+            continue
+        line = line.decode("utf-8")
+        if not line.startswith("data:"):
+            continue
+        payload = line[len("data:") :].strip()
+        if payload == "[DONE]":
+            # Read the rest of the body (the terminating chunk) so urllib3
+            # returns the connection to the pool instead of dropping it.
+            for _ in lines:
+                pass
+            break
+        chunk = json.loads(payload)
+        for choice in chunk.get("choices", []):
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                yield content
+
+
+client = AzureOpenAI(azure_endpoint, api_key, api_version)
+
+
+def runtime_gauges():
+    cache = get_response_cache().stats()
+    semantic = get_semantic_cache().stats()
+    limiter = client.rate_limiter.stats()
+    gauges = [
+        ("llm_cache_hits", {}, cache["hits"]),
+        ("llm_cache_misses", {}, cache["misses"]),
+        ("llm_cache_hit_rate", {}, cache["hit_rate"]),
+        ("llm_cache_entries", {}, cache["entries"]),
+        ("llm_semantic_cache_hit_rate", {}, semantic["hit_rate"]),
+        ("llm_semantic_cache_entries", {}, semantic["entries"]),
+        ("llm_rate_limit_throttled", {}, limiter["throttled"]),
+        ("llm_rate_limit_concurrency_limit", {}, limiter["concurrency_limit"]),
+        ("llm_rate_limit_in_flight", {}, limiter["in_flight"]),
+        ("llm_rate_limit_queue_wait_seconds_max", {}, limiter["queue_wait_seconds_max"]),
+    ]
+    for group in ("llm", "image"):
+        flights = get_flight_group(group).stats()
+        gauges.append(("singleflight_coalesced", {"group": group}, flights["coalesced"]))
+    return gauges
+
+
+registry.register_collector(runtime_gauges)
+
+
+def encode_image(image):
+    data, mime_type, stats = prepare_for_vision(image)
+    return base64.b64encode(data).decode("utf-8"), mime_type, stats
+
+
+def get_image_explanation(base64_image, mime_type="image/png"):
+    # Goes through the client like every other chat call, so vision requests
+    # share the rate limiter, concurrency limit and 429 cooldown.
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant that describes images.",
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Explain the content of this image..."},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{mime_type};base64,{base64_image}"},
+                },
+            ],
+        },
+    ]
+    started = time.monotonic()
+    try:
+        result = client.chat_completion(
+            model=model, messages=messages, temperature=0.7, max_tokens=None
+        )
+    except Exception as e:
+        logging.error(f"Request error: {e}")
+        record_call("get_image_explanation", time.monotonic() - started, status="error")
+        return IMAGE_EXPLANATION_FAILED
+    usage = result.get("usage") or {}
+    record_call(
+        "get_image_explanation",
+        time.monotonic() - started,
+        prompt_tokens=usage.get("prompt_tokens", 0),
+        completion_tokens=usage.get("completion_tokens", 0),
+    )
+    return result["choices"][0]["message"]["content"]
+
+
+def lookup_cached(cache_key, operation):
+    cached = get_response_cache().get(cache_key)
+    result = "miss" if cached is None else "hit"
+    inc("llm_cache_requests_total", operation=operation, result=result)
+    return cached
+
+
+def call_azure_openai(messages, max_tokens, temperature, cache=True, operation="chat"):
+    cache_key = make_key(model, messages, temperature, max_tokens)
+    if cache:
+        cached = lookup_cached(cache_key, operation)
+        if cached is not None:
+            return cached
+
+    def request_content():
+        started = time.monotonic()
+        try:
+            response = client.chat_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+        except Exception:
+            record_call(operation, time.monotonic() - started, status="error")
+            raise
+        usage = response.get("usage") or {}
+        record_call(
+            operation,
+            time.monotonic() - started,
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+        )
+        content = response["choices"][0]["message"]["content"].strip()
+        if cache and content:
+            # Written before the flight resolves, so a caller arriving in
+            # between finds the cache instead of sending a duplicate.
+            get_response_cache().set(cache_key, content)
+        return content
+
+    try:
+        # Identical cacheable requests already in flight are coalesced; calls
+        # that opt out of caching want independent samples and always go out.
+        if cache:
+            content = get_flight_group("llm").do(cache_key, request_content)
+        else:
+            content = request_content()
+    except Exception as e:
+        logging.error(f"OpenAI API call failed: {e}")
+        return API_CALL_FAILED
+    return content
+
+
+def stream_azure_openai(
+    messages,
+    max_tokens,
+    temperature,
+    default="",
+    cache=True,
+    operation="chat",
+    on_complete=None,
+):
+    # on_complete, if given, is called with the full reply once it is known to
+    # be complete; it is never called for failed, cut-off or abandoned streams.
+    cache_key = make_key(model, messages, temperature, max_tokens)
+    if cache:
+        flights = get_flight_group("llm")
+        while True:
+            cached = lookup_cached(cache_key, operation)
+            if cached is not None:
+                yield cached
+                if on_complete is not None:
+                    on_complete(cached)
+                return
+            call, leader = flights.claim(cache_key)
+            if leader:
+                break
+            try:
+                content = call.wait()
+            except Abandoned:
+                # The leader's consumer went away mid-stream (a rerun or
+                # stop); claim again and make the request ourselves.
+                continue
+            except Exception as e:
+                logging.error(f"OpenAI API call failed: {e}")
+                yield API_CALL_FAILED
+                return
+            yield content or default
+            if content and on_complete is not None:
+                on_complete(content)
+            return
+    tokens = []
+    content = None
+    error = None
+    started = time.monotonic()
+    try:
+        for token in client.chat_completion_stream(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        ):
+            if not tokens:
+                observe(
+                    "llm_time_to_first_token_seconds",
+                    time.monotonic() - started,
+                    operation=operation,
+                )
+            tokens.append(token)
+            yield token
+        content = "".join(tokens).strip()
+    except Exception as e:
+        logging.error(f"OpenAI streaming call failed: {e}")
+        record_call(operation, time.monotonic() - started, status="error", stream=True)
+        error = e
+    finally:
+        if cache:
+            if content:
+                get_response_cache().set(cache_key, content)
+            elif content is None and error is None:
+                # Closed before the stream finished.
+                error = Abandoned("Streaming call was abandoned")
+            flights.resolve(cache_key, call, result=content, error=error)
+    if error is not None:
+        if tokens:
+            raise StreamInterrupted(f"Stream failed after {len(tokens)} tokens") from error
+        yield API_CALL_FAILED
+        return
+    # Streamed responses carry no usage block, so token counts are estimated.
+    record_call(
+        operation,
+        time.monotonic() - started,
+        prompt_tokens=estimate_request_tokens(messages, 0),
+        completion_tokens=estimate_tokens(content) if content else 0,
+        stream=True,
+    )
+    if not content:
+        if default:
+            yield default
+    elif on_complete is not None:
+        on_complete(content)
+
+
+def finalize_prompt(conversation, stream=False):
+    user_details = "\n".join(
+        f"{turn['role'].capitalize()}: {turn['content']}" for turn in conversation
+    )
+    prompt = (
+        "Based on the conversation below, create a concise and detailed image description..."
+        f"Conversation:\n{user_details}\nFinal Image Description:"
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": "You are an AI assistant that creates detailed image prompts...",
+        },
+        {"role": "user", "content": prompt},
+    ]
+    if stream:
+        return stream_azure_openai(
+            messages,
+            750,
+            0.7,
+            default=FINALIZE_PROMPT_FAILED,
+            operation="finalize_prompt",
+        )
+    return (
+        call_azure_openai(messages, 750, 0.7, operation="finalize_prompt")
+        or FINALIZE_PROMPT_FAILED
+    )
+
+
+def modify_prompt_with_llm(initial_prompt, user_instruction, stream=False):
+    # Users reword the same tweak to a library prompt in many ways; a close
+    # enough earlier (prompt, instruction) pair skips the round trip.
+    semantic_cache = get_semantic_cache()
+    cached = semantic_cache.get(initial_prompt, user_instruction)
+    inc(
+        "llm_semantic_cache_requests_total",
+        operation="modify_prompt_with_llm",
+        result="miss" if cached is None else "hit",
+    )
+    if cached is not None:
+        return iter([cached]) if stream else cached
+
+    prompt = (
+        f"You are an assistant that modifies image descriptions based on user input.\n"
+        f"Initial Description:\n{initial_prompt}\n\n"
+        f"User Instruction:\n{user_instruction}\n\n"
+        "Please update the initial description by incorporating the user's instruction..."
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": "You are skilled at updating image descriptions...",
+        },
+        {"role": "user", "content": prompt},
+    ]
+
+    def remember(content):
+        if content and content not in (API_CALL_FAILED, MODIFY_PROMPT_FAILED):
+            semantic_cache.set(initial_prompt, user_instruction, content)
+
+    if stream:
+        return stream_azure_openai(
+            messages,
+            150,
+            0.7,
+            default=MODIFY_PROMPT_FAILED,
+            operation="modify_prompt_with_llm",
+            on_complete=remember,
+        )
+    content = (
+        call_azure_openai(messages, 150, 0.7, operation="modify_prompt_with_llm")
+        or MODIFY_PROMPT_FAILED
+    )
+    remember(content)
+    return content
+
+
+def generate_image(prompt, store_images=False):
+    urls = generate_images(prompt, store_images=store_images)
+    return urls[0] if urls else IMAGE_GENERATION_FAILED
+
+
+def generate_images(prompt, fresh=False, store_images=False):
+    # Returns every URL the backend produced for the prompt, or an empty list.
+    # fresh=True skips request coalescing, for callers that want another
+    # independent sample of a prompt already in flight. store_images=True
+    # downloads the results into the image store before returning.
+    if fresh:
+        return request_images(prompt, store_images)
+    return get_flight_group("image").do(
+        prompt, lambda: request_images(prompt, store_images)
+    )
+
+
+def request_images(prompt, store_images=False):
+    started = time.monotonic()
+    try:
+        response = get_session().post(
+            IMAGE_GENERATION_URL,
+            json={"prompt": prompt},
+            headers={"Content-Type": "application/json"},
+            timeout=(CONNECT_TIMEOUT, IMAGE_REQUEST_TIMEOUT),
+        )
+        if response.status_code == 200:
+            data = response.json()
+            image_urls = [
+                url for url in data.get("imageUrls", []) if url.startswith("http")
+            ]
+            record_call(
+                "generate_image", time.monotonic() - started, images=len(image_urls)
+            )
+            if store_images:
+                for url in image_urls:
+                    get_image_store().fetch(url)
+            return image_urls
+        record_call(
+            "generate_image",
+            time.monotonic() - started,
+            status=str(response.status_code),
+        )
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Image generation failed: {e}")
+        record_call("generate_image", time.monotonic() - started, status="error")
+    return []
+
+
+def generate_prompt_variations(prompt, count):
+    instruction = (
+        f"Write {count} distinct variations of the image description below. Keep "
+        "the subject, and vary the composition, lighting, palette or style. "
+        "Return one variation per line, without numbering.\n\n"
+        f"Description:\n{prompt}"
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": "You are an AI assistant that creates detailed image prompts...",
+        },
+        {"role": "user", "content": instruction},
+    ]
+    content = call_azure_openai(
+        messages, 200 * count, 0.9, cache=False, operation="generate_prompt_variations"
+    )
+    variations = []
+    if content and content != API_CALL_FAILED:
+        for line in content.splitlines():
+            line = VARIATION_PREFIX.sub("", line).strip()
+            if line:
+                variations.append(line)
+    # Short or failed replies are padded with the original prompt, so the
+    # caller always gets `count` prompts to generate from.
+    variations = variations[:count]
+    return variations + [prompt] * (count - len(variations))
+
+
+def generate_dynamic_questions(user_input, conversation_history, stream=False):
+    prompt = (
+        f'We are working with the initial concept:\n"{user_input}"\n\n'
+        f"Conversation so far:\n{conversation_history}\n\n"
+        "Please generate a follow-up question that explores one aspect such as colors, textures, shapes, lighting, depth, or style."
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a creative assistant who generates insightful questions and recommendations.",
+        },
+        {"role": "user", "content": prompt},
+    ]
+    if stream:
+        return stream_azure_openai(
+            messages,
+            750,
+            0.8,
+            default="Couldn't generate a question.",
+            cache=False,
+            operation="generate_dynamic_questions",
+        )
+    response_content = call_azure_openai(
+        messages, 750, 0.8, cache=False, operation="generate_dynamic_questions"
+    )
+    return (
+        response_content.strip()
+        if response_content
+        else "Couldn't generate a question."
+    )
+
+
+def generate_recommendation(user_input, conversation_history):
+    prompt = (
+        f'We are working with the initial concept: "{user_input}". '
+        f'Given the conversation so far: "{conversation_history}", generate a short recommendation to inspire the user further.'
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a creative assistant who generates concise recommendations.",
+        },
+        {"role": "user", "content": prompt},
+    ]
+    recommendation = call_azure_openai(
+        messages, 150, 0.8, cache=False, operation="generate_recommendation"
+    )
+    return recommendation.strip()
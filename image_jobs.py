@@ -0,0 +1,190 @@
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Workers spend nearly all their time waiting on HTTP, so the pool is sized
+# for many concurrent sessions; each session may occupy only a few of them.
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", "32"))
+IMAGE_JOB_SESSION_LIMIT = int(os.getenv("IMAGE_JOB_SESSION_LIMIT", "4"))
+# Limits on time spent running, and separately on time spent waiting for a
+# worker; the pool is shared by every session in the process.
+IMAGE_JOB_TIMEOUT = float(os.getenv("IMAGE_JOB_TIMEOUT", "180"))
+IMAGE_JOB_QUEUE_TIMEOUT = float(os.getenv("IMAGE_JOB_QUEUE_TIMEOUT", "600"))
+IMAGE_JOB_RETENTION = float(os.getenv("IMAGE_JOB_RETENTION", "900"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timed out"
+FINISHED = (DONE, FAILED, CANCELLED, TIMED_OUT)
+
+
+class Job:
+    def __init__(self, prompt, timeout, session):
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.timeout = timeout
+        self.session = session
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.run = None
+
+    def elapsed(self):
+        end = self.finished_at or time.time()
+        return end - (self.started_at or self.submitted_at)
+
+
+class JobQueue:
+    # Runs blocking work on a bounded pool so the Streamlit script thread only
+    # submits and polls. Running work cannot be interrupted: cancelling or
+    # timing out a running job marks it finished and discards its result, but
+    # its worker stays busy until the call returns. Image requests carry their
+    # own HTTP timeout (IMAGE_REQUEST_TIMEOUT), shorter than the job timeout,
+    # which bounds how long that can be.
+    #
+    # A session hands at most session_limit jobs to the pool at a time and the
+    # rest wait in its own pending queue. A slot is held until the worker
+    # returns, so cancelling and resubmitting cannot pile up busy workers.
+    # Jobs submitted without a session share one allowance.
+    def __init__(
+        self,
+        workers=IMAGE_JOB_WORKERS,
+        timeout=IMAGE_JOB_TIMEOUT,
+        queue_timeout=IMAGE_JOB_QUEUE_TIMEOUT,
+        session_limit=IMAGE_JOB_SESSION_LIMIT,
+    ):
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.session_limit = session_limit
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="image-job"
+        )
+        self._jobs = {}
+        self._pending = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, prompt, timeout=None, session=None):
+        self._prune()
+        job = Job(prompt, timeout or self.timeout, session)
+        context = contextvars.copy_context()
+        job.run = functools.partial(context.run, self._run, job, fn)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._pending.setdefault(session, deque()).append(job)
+            self._dispatch(session)
+        return job.id
+
+    def _dispatch(self, session):
+        # Called with the lock held.
+        pending = self._pending.get(session)
+        while pending and self._active.get(session, 0) < self.session_limit:
+            job = pending.popleft()
+            if job.status == QUEUED:
+                self._active[session] = self._active.get(session, 0) + 1
+                job.future = self._executor.submit(job.run)
+        if not pending:
+            self._pending.pop(session, None)
+
+    def _release(self, session):
+        # Called with the lock held, once per job handed to the pool.
+        self._active[session] -= 1
+        if not self._active[session]:
+            del self._active[session]
+        self._dispatch(session)
+
+    def _run(self, job, fn):
+        try:
+            with self._lock:
+                if job.status != QUEUED:
+                    return
+                job.status = RUNNING
+                job.started_at = time.time()
+            try:
+                result, error = fn(job.prompt), None
+            except Exception as e:
+                logging.error(f"Image job {job.id} failed: {e}")
+                result, error = None, str(e)
+            with self._lock:
+                if job.status != RUNNING:
+                    return
+                job.result = result
+                job.error = error
+                job.status = FAILED if error else DONE
+                job.finished_at = time.time()
+        finally:
+            with self._lock:
+                self._release(job.session)
+
+    def _finish(self, job, status):
+        # Called with the lock held. A job still waiting in the pool gives its
+        # session slot back here, since _run will never see it.
+        if job.future is not None and job.future.cancel():
+            self._release(job.session)
+        job.status = status
+        job.finished_at = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and self._expired(job):
+                self._finish(job, TIMED_OUT)
+            return job
+
+    def _expired(self, job):
+        if job.status == QUEUED:
+            return time.time() - job.submitted_at > self.queue_timeout
+        if job.status == RUNNING:
+            return time.time() - job.started_at > job.timeout
+        return False
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return False
+            self._finish(job, CANCELLED)
+            return True
+
+    def _prune(self):
+        cutoff = time.time() - IMAGE_JOB_RETENTION
+        with self._lock:
+            for job_id in [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job.status in FINISHED and job.finished_at < cutoff
+            ]:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
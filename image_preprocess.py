@@ -0,0 +1,91 @@
+import math
+import os
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# GPT-4o vision scales high-detail images to fit 2048x2048 and then to a
+# 768px shortest side before tiling, so anything larger is wasted upload.
+VISION_MAX_DIMENSION = int(os.getenv("VISION_MAX_DIMENSION", "2048"))
+VISION_SHORT_SIDE = int(os.getenv("VISION_SHORT_SIDE", "768"))
+VISION_MAX_BYTES = int(os.getenv("VISION_MAX_BYTES", str(1024 * 1024)))
+VISION_IMAGE_FORMAT = os.getenv("VISION_IMAGE_FORMAT", "JPEG").upper()
+VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "85"))
+VISION_MIN_QUALITY = 50
+# High-detail images are billed a fixed base plus a charge per 512px tile.
+VISION_BASE_TOKENS = 85
+VISION_TILE_TOKENS = 170
+VISION_TILE_SIZE = 512
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def has_alpha(image):
+    return image.mode in ("RGBA", "LA") or (
+        image.mode == "P" and "transparency" in image.info
+    )
+
+
+def fit_for_vision(image, max_dimension=VISION_MAX_DIMENSION, short_side=VISION_SHORT_SIDE):
+    width, height = image.size
+    scale = min(1.0, max_dimension / max(width, height), short_side / min(width, height))
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.LANCZOS)
+
+
+def estimate_image_tokens(size):
+    width, height = size
+    tiles = math.ceil(width / VISION_TILE_SIZE) * math.ceil(height / VISION_TILE_SIZE)
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * tiles
+
+
+def encode(image, image_format, quality):
+    buffered = BytesIO()
+    if image_format == "PNG":
+        image.save(buffered, format="PNG", optimize=True)
+    else:
+        image.save(buffered, format=image_format, quality=quality)
+    return buffered.getvalue()
+
+
+def prepare_for_vision(
+    image,
+    image_format=VISION_IMAGE_FORMAT,
+    quality=VISION_IMAGE_QUALITY,
+    max_bytes=VISION_MAX_BYTES,
+):
+    original_size = image.size
+    image = ImageOps.exif_transpose(image)
+    # JPEG cannot carry transparency; WebP keeps it at a lossy size.
+    if has_alpha(image):
+        if image_format == "JPEG":
+            image_format = "WEBP"
+        image = image.convert("RGBA")
+    else:
+        image = image.convert("RGB")
+    image = fit_for_vision(image)
+
+    data = encode(image, image_format, quality)
+    # Trade quality first, then resolution, until the payload fits the budget.
+    while len(data) > max_bytes:
+        if image_format != "PNG" and quality > VISION_MIN_QUALITY:
+            quality = max(VISION_MIN_QUALITY, quality - 10)
+        elif min(image.size) > 64:
+            width, height = image.size
+            image = image.resize(
+                (max(1, int(width * 0.75)), max(1, int(height * 0.75))), Image.LANCZOS
+            )
+        else:
+            break
+        data = encode(image, image_format, quality)
+
+    stats = {
+        "original_size": original_size,
+        "size": image.size,
+        "format": image_format,
+        "quality": quality,
+        "encoded_bytes": len(data),
+    }
+    return data, MIME_TYPES[image_format], stats
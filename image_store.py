@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from http_client import get_session
+from metrics import record_call
+
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", ".image_store")
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageStore:
+    # Blobs are stored under their SHA-256 digest. Aliases (source URLs) are
+    # small files that point at a digest, so one image is stored once however
+    # it was reached. Eviction is LRU by total bytes,
+    # using file mtimes to carry recency across restarts, and removes the
+    # aliases that point at an evicted blob.
+    def __init__(self, root=IMAGE_STORE_DIR, max_bytes=IMAGE_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(root, "blobs")
+        self.alias_dir = os.path.join(root, "aliases")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.alias_dir, exist_ok=True)
+        self._sizes = OrderedDict()
+        self._total = 0
+        self._aliases = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        blobs = []
+        for name in os.listdir(self.blob_dir):
+            if name.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(self.blob_dir, name))
+            blobs.append((stat.st_mtime, name, stat.st_size))
+        for _, digest, size in sorted(blobs):
+            self._sizes[digest] = size
+            self._total += size
+        for name in os.listdir(self.alias_dir):
+            path = os.path.join(self.alias_dir, name)
+            digest = self._read_alias(path)
+            if digest in self._sizes:
+                self._register(path, digest)
+            else:
+                os.remove(path)
+
+    @staticmethod
+    def _read_alias(path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _register(self, path, digest):
+        self._aliases.setdefault(digest, set()).add(path)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def _alias_path(self, alias):
+        return os.path.join(self.alias_dir, content_hash(alias.encode("utf-8")))
+
+    def put(self, data):
+        digest = content_hash(data)
+        with self._lock:
+            if digest in self._sizes:
+                self._sizes.move_to_end(digest)
+                return digest
+            path = self._blob_path(digest)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._sizes[digest] = len(data)
+            self._total += len(data)
+            self._evict()
+        return digest
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._sizes) > 1:
+            digest, size = self._sizes.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+            for path in self._aliases.pop(digest, ()):
+                # The alias may have been rewritten to point elsewhere since.
+                if self._read_alias(path) == digest:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def get(self, digest):
+        with self._lock:
+            if digest not in self._sizes:
+                return None
+            self._sizes.move_to_end(digest)
+        path = self._blob_path(digest)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def link(self, alias, digest):
+        path = self._alias_path(alias)
+        with self._lock:
+            with open(path, "w") as f:
+                f.write(digest)
+            self._register(path, digest)
+
+    def resolve(self, alias):
+        digest = self._read_alias(self._alias_path(alias))
+        with self._lock:
+            return digest if digest in self._sizes else None
+
+    def fetch(self, url):
+        digest = self.resolve(f"url:{url}")
+        if digest is not None:
+            return digest
+        started = time.monotonic()
+        try:
+            response = get_session().get(url)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Image download failed: {e}")
+            record_call("image_download", time.monotonic() - started, status="error")
+            return None
+        record_call(
+            "image_download", time.monotonic() - started, bytes=len(response.content)
+        )
+        digest = self.put(response.content)
+        self.link(f"url:{url}", digest)
+        return digest
+
+    def stats(self):
+        with self._lock:
+            return {"images": len(self._sizes), "bytes": self._total}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_image_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ImageStore()
+    return _store
@@ -0,0 +1,178 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Set METRICS_PORT to serve Prometheus text on http://0.0.0.0:<port>/metrics and
+# METRICS_JSONL_PATH to append one JSON line per outbound call.
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_JSONL_PATH = os.getenv("METRICS_JSONL_PATH")
+SHOW_TIMING_PANEL = os.getenv("SHOW_TIMING_PANEL", "").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Per-session sink for call events, bound by the Streamlit script and carried
+# into worker threads by concurrency.submit and the image job queue.
+session_events = contextvars.ContextVar("session_events", default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def register_collector(self, collector):
+        # A collector returns (name, labels, value) gauges read at render time.
+        with self._lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            collectors = list(self.collectors)
+        for (name, labels), value in counters:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                bucket_labels = labels + (("le", bound),)
+                lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {count}")
+            inf_labels = labels + (("le", "+Inf"),)
+            lines.append(f"{name}_bucket{_format_labels(inf_labels)} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for collector in collectors:
+            try:
+                gauges = collector()
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+                continue
+            for name, labels, value in gauges:
+                lines.append(f"{name}{_format_labels(_label_key(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+_jsonl_lock = threading.Lock()
+
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def record_call(
+    operation, seconds, status="ok", prompt_tokens=0, completion_tokens=0, **fields
+):
+    registry.observe("outbound_call_seconds", seconds, operation=operation, status=status)
+    registry.inc("outbound_calls_total", operation=operation, status=status)
+    if prompt_tokens:
+        registry.inc("llm_tokens_total", prompt_tokens, operation=operation, kind="prompt")
+    if completion_tokens:
+        registry.inc(
+            "llm_tokens_total", completion_tokens, operation=operation, kind="completion"
+        )
+    event = {
+        "time": time.time(),
+        "operation": operation,
+        "seconds": round(seconds, 4),
+        "status": status,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        **fields,
+    }
+    events = session_events.get()
+    if events is not None:
+        events.append(event)
+    if METRICS_JSONL_PATH:
+        with _jsonl_lock, open(METRICS_JSONL_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(event) + "\n")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT):
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("0.0.0.0", int(port)), MetricsHandler)
+            except OSError as e:
+                logging.error(f"Metrics server could not start on port {port}: {e}")
+                return None
+            threading.Thread(
+                target=_server.serve_forever, name="metrics", daemon=True
+            ).start()
+            logging.info(f"Serving metrics on port {port}")
+    return _server
@@ -0,0 +1,106 @@
+import bisect
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+
+PROMPT_LIBRARY_PATH = os.getenv(
+    "PROMPT_LIBRARY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_library.json"),
+)
+
+# Title matches rank above matches that only occur in the prompt text.
+TITLE_WEIGHT = 3
+
+PromptEntry = namedtuple("PromptEntry", ["id", "category", "title", "prompt"])
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+
+class PromptLibrary:
+    # The inverted index is built once per process when the library is loaded,
+    # so a search costs a few dictionary lookups regardless of library size.
+    def __init__(self, categories):
+        self.entries = []
+        self.categories = []
+        self.by_category = {}
+        for category in categories:
+            name = category["name"]
+            self.categories.append(name)
+            ids = self.by_category.setdefault(name, [])
+            for prompt in category["prompts"]:
+                entry = PromptEntry(
+                    len(self.entries), name, prompt["title"], prompt["prompt"]
+                )
+                self.entries.append(entry)
+                ids.append(entry.id)
+        self.postings = {}
+        for entry in self.entries:
+            weights = {}
+            for token in tokenize(entry.prompt) + tokenize(entry.category):
+                weights[token] = weights.get(token, 0) + 1
+            for token in tokenize(entry.title):
+                weights[token] = weights.get(token, 0) + TITLE_WEIGHT
+            for token, weight in weights.items():
+                self.postings.setdefault(token, {})[entry.id] = weight
+        self.vocabulary = sorted(self.postings)
+
+    @classmethod
+    def load(cls, path=PROMPT_LIBRARY_PATH):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f)["categories"])
+
+    def _prefix_scores(self, prefix):
+        # The last word of a query is usually still being typed, so every
+        # query term matches as a prefix of indexed words.
+        scores = {}
+        index = bisect.bisect_left(self.vocabulary, prefix)
+        while index < len(self.vocabulary) and self.vocabulary[index].startswith(prefix):
+            for entry_id, weight in self.postings[self.vocabulary[index]].items():
+                scores[entry_id] = scores.get(entry_id, 0) + weight
+            index += 1
+        return scores
+
+    def search(self, query="", category=None):
+        tokens = tokenize(query)
+        if not tokens:
+            ids = self.by_category.get(category, []) if category else range(len(self.entries))
+            return [self.entries[entry_id] for entry_id in ids]
+        scores = None
+        for token in tokens:
+            token_scores = self._prefix_scores(token)
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {
+                    entry_id: score + token_scores[entry_id]
+                    for entry_id, score in scores.items()
+                    if entry_id in token_scores
+                }
+            if not scores:
+                return []
+        results = [
+            self.entries[entry_id]
+            for entry_id in scores
+            if not category or self.entries[entry_id].category == category
+        ]
+        results.sort(key=lambda entry: (-scores[entry.id], entry.id))
+        return results
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_prompt_library():
+    global _library
+    if _library is None:
+        with _library_lock:
+            if _library is None:
+                _library = PromptLibrary.load()
+    return _library
@@ -0,0 +1,186 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+REQUESTS_PER_MINUTE = int(os.getenv("AZURE_RPM_LIMIT", "300"))
+TOKENS_PER_MINUTE = int(os.getenv("AZURE_TPM_LIMIT", "60000"))
+MAX_CONCURRENCY = int(os.getenv("AZURE_MAX_CONCURRENCY", "16"))
+
+BACKOFF_BASE = 1
+BACKOFF_CAP = 32
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    # Accepts plain seconds ("2", "0.5") and Go-style durations ("6m0s", "20ms").
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after_seconds(response):
+    headers = response.headers
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        value = headers["retry-after"]
+        seconds = parse_duration(value)
+        if seconds is not None:
+            return seconds
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+    resets = [
+        parse_duration(headers[name])
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if name in headers
+    ]
+    resets = [seconds for seconds in resets if seconds is not None]
+    return max(resets) if resets else None
+
+
+def backoff_delay(attempt, response=None):
+    # Server hints win; a little jitter on top keeps sessions that were throttled
+    # together from retrying in lockstep. Otherwise use full-jitter exponential.
+    hinted = retry_after_seconds(response) if response is not None else None
+    if hinted is not None:
+        return min(hinted, BACKOFF_CAP) + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_BASE * 2**attempt, BACKOFF_CAP))
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        # Debits immediately and may go negative; the returned wait makes callers
+        # queue in arrival order without polling.
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return max(-self.tokens / self.rate, 0)
+
+
+class AdaptiveConcurrency:
+    # AIMD: halve the limit on every 429, grow it by roughly one slot per
+    # window of successful calls.
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+        max_concurrency=MAX_CONCURRENCY,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.paused_until = 0.0
+        self.acquired = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Shared cooldown after a 429 so every session backs off, not just the
+        # one that was rejected.
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, estimated_tokens):
+        start = time.monotonic()
+        cooldown = self.paused_until - start
+        if cooldown > 0:
+            time.sleep(cooldown)
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if wait > 0:
+            time.sleep(wait)
+        self.concurrency.acquire()
+        waited = time.monotonic() - start
+        with self._lock:
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        if waited > 1:
+            logging.info(f"Waited {waited:.2f} seconds for Azure OpenAI quota")
+        return waited
+
+    def release(self, throttled=False):
+        if throttled:
+            with self._lock:
+                self.throttled += 1
+        self.concurrency.release(throttled=throttled)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "throttled": self.throttled,
+                "queue_wait_seconds_total": self.total_wait,
+                "queue_wait_seconds_max": self.max_wait,
+                "queue_wait_seconds_avg": (
+                    self.total_wait / self.acquired if self.acquired else 0.0
+                ),
+                "concurrency_limit": int(self.concurrency.limit),
+                "in_flight": self.concurrency.in_flight,
+            }
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter()
+    return _limiter
@@ -0,0 +1,185 @@
+import functools
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+# A stored refinement is reused only for the same base prompt (after
+# normalisation) when the instructions' content words agree: their combined
+# vectors must reach SEMANTIC_CACHE_THRESHOLD and every word on each side
+# needs a counterpart at SEMANTIC_CACHE_WORD_THRESHOLD. Filler words are
+# ignored by both. Set SEMANTIC_CACHE_MAX_ENTRIES=0 to disable.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))
+# Hashed n-grams score "rain"/"train" like "rain"/"rainy" (0.55), so word
+# matching stays strict: it admits inflections of longer words such as
+# "mountains"/"mountain" (0.74), not different words.
+SEMANTIC_CACHE_WORD_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_WORD_THRESHOLD", "0.7"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "512"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "2048"))
+NGRAM_SIZE = 3
+
+_WORD = re.compile(r"[a-z0-9]+")
+# Filler that does not change what an instruction asks for. Verbs that do
+# ("add", "remove", "replace") and comparatives ("more", "less") are content.
+STOPWORDS = frozenset(
+    (
+        "a an the it its this that these those to at in into on onto of for "
+        "with and or by as is be are was please can could would you me i we "
+        "make change turn set let just so some"
+    ).split()
+)
+
+
+def normalize(text):
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def content_words(text):
+    return tuple(
+        sorted({word for word in normalize(text).split() if word not in STOPWORDS})
+    )
+
+
+def embed(text, dim=SEMANTIC_CACHE_DIM):
+    # Signed feature hashing of word unigrams and padded character n-grams,
+    # L2-normalised so a dot product is the cosine similarity.
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in normalize(text).split():
+        features = [word]
+        padded = f" {word} "
+        features.extend(
+            padded[i : i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)
+        )
+        for feature in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@functools.lru_cache(maxsize=4096)
+def embed_word(word, dim=SEMANTIC_CACHE_DIM):
+    return embed(word, dim)
+
+
+def words_match(
+    words, other, threshold=SEMANTIC_CACHE_WORD_THRESHOLD, dim=SEMANTIC_CACHE_DIM
+):
+    # Every word on each side must have a close counterpart on the other, so a
+    # swapped word ("dog" / "cat", "add" / "remove") is a miss.
+    if not words or not other:
+        return words == other
+    scores = np.stack([embed_word(w, dim) for w in words]) @ np.stack(
+        [embed_word(w, dim) for w in other]
+    ).T
+    return bool(
+        (scores.max(axis=1) >= threshold).all()
+        and (scores.max(axis=0) >= threshold).all()
+    )
+
+
+class SemanticCache:
+    # Catches rewordings of the same tweak that differ in case, punctuation,
+    # word order or filler ("make it night" / "turn it to night please").
+    # Hashed n-grams cannot tell that one swapped content word ("dog" / "cat",
+    # "add" / "remove") flips the meaning, hence the per-word check.
+    #
+    # Content-word vectors live in a fixed-size NumPy matrix so a lookup is one
+    # matrix-vector product, masked to entries for the same base prompt. When
+    # full, the least recently used slot is overwritten.
+    def __init__(
+        self,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        word_threshold=SEMANTIC_CACHE_WORD_THRESHOLD,
+        dim=SEMANTIC_CACHE_DIM,
+    ):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.word_threshold = word_threshold
+        self.dim = dim
+        self._instructions = np.zeros((max_entries, dim), dtype=np.float32)
+        self._base_hashes = np.zeros(max_entries, dtype=np.int64)
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._bases = [None] * max_entries
+        self._words = [None] * max_entries
+        self._values = [None] * max_entries
+        self._size = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _query(self, base, instruction):
+        base = normalize(base)
+        words = content_words(instruction)
+        return (
+            base,
+            zlib.crc32(base.encode("utf-8")),
+            embed(" ".join(words), self.dim),
+            words,
+        )
+
+    def get(self, base, instruction):
+        if not self.max_entries:
+            return None
+        base, base_hash, vector, words = self._query(base, instruction)
+        with self._lock:
+            if self._size:
+                scores = self._instructions[: self._size] @ vector
+                scores[self._base_hashes[: self._size] != base_hash] = -1.0
+                for slot in np.argsort(scores)[::-1]:
+                    if scores[slot] < self.threshold:
+                        break
+                    if self._bases[slot] == base and words_match(
+                        words, self._words[slot], self.word_threshold, self.dim
+                    ):
+                        self._clock += 1
+                        self._last_used[slot] = self._clock
+                        self.hits += 1
+                        return self._values[slot]
+            self.misses += 1
+            return None
+
+    def set(self, base, instruction, value):
+        if not self.max_entries:
+            return
+        base, base_hash, vector, words = self._query(base, instruction)
+        with self._lock:
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+            self._instructions[slot] = vector
+            self._base_hashes[slot] = base_hash
+            self._bases[slot] = base
+            self._words[slot] = words
+            self._values[slot] = value
+            self._clock += 1
+            self._last_used[slot] = self._clock
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": self._size,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticCache()
+    return _cache
@@ -0,0 +1,83 @@
+import threading
+
+
+class Abandoned(Exception):
+    # Resolved onto a call whose leader stopped before finishing, e.g. a stream
+    # whose consumer went away. Followers should retry rather than fail.
+    pass
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for in-flight request")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    # Concurrent callers with the same key share one execution: the first caller
+    # (the leader) does the work and everyone else waits for its outcome.
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def claim(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self.coalesced += 1
+                return call, False
+            call = Call()
+            self._calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def resolve(self, key, call, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.result = result
+        call.error = error
+        call.done.set()
+
+    def do(self, key, fn):
+        call, leader = self.claim(key)
+        if not leader:
+            return call.wait()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.resolve(key, call, error=e)
+            raise
+        self.resolve(key, call, result=result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def get_flight_group(name):
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight()
+        return _groups[name]